@@ -1,14 +1,65 @@
+import http.client
+import io
 import json
 import os
 import re
-import boto3
-import urllib.request
+import string
+import time
 import urllib.error
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 
-ssm = boto3.client("ssm")
 OPENAI_URL = "https://api.openai.com/v1/responses"
 MAX_GENERATION_ATTEMPTS = 3
+_PROMPTS_DIR = os.path.join(os.path.dirname(__file__), "prompts")
+_OPENAI_URL_PARTS = urllib.parse.urlsplit(OPENAI_URL)
+_OPENAI_TIMEOUT = 30
+# Lambda caps the init phase at 10s; all network warm-up shares one deadline well inside it,
+# and the OpenAI pre-connect only runs if its own short timeout still fits.
+_INIT_WARMUP_BUDGET = 6
+_OPENAI_WARMUP_TIMEOUT = 2
+# Per-container state, populated by _init() at import and reused across warm invocations.
+_SSM = None
 _TEMPLATES = None
+_OPENAI_CONN = None
+# Set once the connection has served a response (or was pre-opened during init) and then sat
+# idle; only such a socket is safe to resend on if the server has since closed it.
+_OPENAI_CONN_WARM = False
+_POOL = ThreadPoolExecutor(max_workers=2)
+_API_KEY = None
+_API_KEY_TS = 0.0
+_API_HEADERS = None
+_API_KEY_TTL = int(os.environ.get("OPENAI_KEY_TTL", "900"))
+_STORY_CONTENT_TYPES = frozenset(("output_text", "text"))
+# Prompt context fields and the request keys read for each, new API contract first and
+# existing frontend fields as fallbacks.
+_PROMPT_FIELDS = (
+    ("vehicle", ("vehicle",)),
+    ("vin", ("vin",)),
+    ("mileage", ("mileage",)),
+    ("concern", ("concern",)),
+    ("codes_symptoms", ("codes_symptoms", "diagnosis")),
+    ("diag_steps", ("diag_steps", "diagnosis")),
+    ("repair_steps", ("repair_steps", "repair")),
+    ("extra_instructions", ("extra_instructions", "comment", "extra")),
+)
+_PROMPT_FIELD_NAMES = tuple(name for name, _ in _PROMPT_FIELDS)
+# Literal story format violations, checked with plain substring search.
+_FORMAT_VIOLATION_LITERALS = (
+    "Customer states",  # forbidden phrase
+    "—",  # em dash
+    "–",  # en dash
+)
+# Line-anchored story format checks fused into one pattern so they cost a single scan.
+_FORMAT_VIOLATION_RE = re.compile(
+    r"^\s*[-*•]\s+"  # bullets
+    r"|^\s*\d+[.)]\s+"  # numbered lists
+    r"|\n\s*\n"  # empty lines
+    r"|^\s*(?i:VIN|Diagnosis|Repair|Parts|Time)\s*:",  # labels
+    re.M,
+)
 
 
 def _load_text(path: str) -> str:
@@ -16,49 +67,110 @@ def _load_text(path: str) -> str:
         return f.read()
 
 
-def _load_templates() -> dict:
-    base_dir = os.path.dirname(__file__)
-    pdir = os.path.join(base_dir, "prompts")
+def _load_prompt_texts(pdir: str) -> dict:
+    # Deploy packages ship prompts pre-packed into one JSON file (see deploy workflow);
+    # local checkouts fall back to reading the individual .txt files. A bundle always wins,
+    # so a locally generated _bundle.json must be deleted after editing the .txt prompts.
+    bundle_path = os.path.join(pdir, "_bundle.json")
+    if os.path.exists(bundle_path):
+        return json.loads(_load_text(bundle_path))
     return {
-        "system_rules": _load_text(os.path.join(pdir, "system_rules.txt")).strip(),
-        "base_rules": _load_text(os.path.join(pdir, "base_rules.txt")).strip(),
-        "mode_rules": {
-            "warranty": _load_text(os.path.join(pdir, "mode_warranty.txt")).strip(),
-            "cp": _load_text(os.path.join(pdir, "mode_cp.txt")).strip(),
+        entry.name[:-4]: _load_text(entry.path)
+        for entry in os.scandir(pdir)
+        if entry.is_file() and entry.name.endswith(".txt")
+    }
+
+
+def _load_templates(pdir: str = _PROMPTS_DIR) -> dict:
+    p = _load_prompt_texts(pdir)
+    base_rules = p["base_rules"].strip()
+    mode_rules = {
+        "warranty": p["mode_warranty"].strip(),
+        "cp": p["mode_cp"].strip(),
+    }
+    output_rules = p["output_rules"].strip()
+    section_inputs = {
+        "diag": p["section_diag_only"].strip(),
+        "repair": p["section_repair_only"].strip(),
+        "diag_repair": p["section_diag_repair"].strip(),
+    }
+    return {
+        "system_rules": p["system_rules"].strip(),
+        # Stacked base + job type + output rules, joined once per job type.
+        "rules_by_job_type": {
+            job_type: "\n".join([base_rules, rules, output_rules]).strip()
+            for job_type, rules in mode_rules.items()
         },
-        "section_inputs": {
-            "diag": _load_text(os.path.join(pdir, "section_diag_only.txt")).strip(),
-            "repair": _load_text(os.path.join(pdir, "section_repair_only.txt")).strip(),
-            "diag_repair": _load_text(os.path.join(pdir, "section_diag_repair.txt")).strip(),
+        # Templates pre-split into (literal, field) pairs so per-request rendering is a plain join.
+        "section_segments": {
+            mode: tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(text))
+            for mode, text in section_inputs.items()
         },
-        "output_rules": _load_text(os.path.join(pdir, "output_rules.txt")).strip(),
     }
 
 
-def _get_templates() -> dict:
-    global _TEMPLATES
-    if _TEMPLATES is None:
-        _TEMPLATES = _load_templates()
-    return _TEMPLATES
+_RESPONSE_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": os.environ.get("CORS_ORIGIN", "*"),
+    "Access-Control-Allow-Headers": "content-type",
+    "Access-Control-Allow-Methods": "POST,OPTIONS",
+}
 
 
 def _resp(status: int, body: dict):
     return {
         "statusCode": status,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": os.environ.get("CORS_ORIGIN", "*"),
-            "Access-Control-Allow-Headers": "content-type",
-            "Access-Control-Allow-Methods": "POST,OPTIONS",
-        },
-        "body": json.dumps(body),
+        "headers": dict(_RESPONSE_HEADERS),
+        "body": json.dumps(body, separators=(",", ":")),
     }
 
 
+# CORS preflight responses never vary, so the body is serialized once; each request still
+# gets its own envelope and headers dict so callers cannot mutate shared state.
+_OPTIONS_RESPONSE = _resp(200, {"ok": True})
+
+
+def _ssm_client():
+    # boto3 is imported and the client built on first key fetch, keeping the import off other paths.
+    global _SSM
+    if _SSM is None:
+        import boto3
+        from botocore.config import Config
+
+        # Short timeouts and at most two total attempts (one retry) bound a slow SSM call to
+        # a few seconds; init additionally stops waiting at its warm-up deadline.
+        _SSM = boto3.client(
+            "ssm",
+            config=Config(
+                tcp_keepalive=True,
+                max_pool_connections=1,
+                connect_timeout=1,
+                read_timeout=3,
+                retries={"total_max_attempts": 2, "mode": "standard"},
+            ),
+        )
+    return _SSM
+
+
+def _openai_key_is_fresh() -> bool:
+    return _API_KEY is not None and time.monotonic() - _API_KEY_TS < _API_KEY_TTL
+
+
 def _get_openai_key() -> str:
+    # Warm containers reuse the decrypted key until the TTL expires.
+    global _API_KEY, _API_KEY_TS, _API_HEADERS
+    if _openai_key_is_fresh():
+        return _API_KEY
     param_name = os.environ["OPENAI_PARAM_NAME"]
-    resp = ssm.get_parameter(Name=param_name, WithDecryption=True)
-    return resp["Parameter"]["Value"]
+    resp = _ssm_client().get_parameter(Name=param_name, WithDecryption=True)
+    _API_KEY = resp["Parameter"]["Value"]
+    _API_KEY_TS = time.monotonic()
+    _API_HEADERS = _openai_headers(_API_KEY)
+    return _API_KEY
+
+
+def _openai_headers(api_key: str) -> dict:
+    return {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
 
 
 def _safe(v):
@@ -88,39 +200,87 @@ def _normalized_mode(data: dict) -> str:
     return mode_map.get(raw, "diag_repair")
 
 
+def _field_value(data: dict, keys: tuple) -> str:
+    for key in keys:
+        value = data.get(key)
+        if value:
+            return value.strip()
+    return ""
+
+
 def _build_prompt(data: dict) -> str:
-    t = _get_templates()
-    job_type = _normalized_job_type(data)
-    mode = _normalized_mode(data)
-
-    # Supports new API contract while remaining backward compatible with existing frontend fields.
-    ctx = {
-        "job_type": job_type,
-        "mode": mode,
-        "vehicle": _safe(data.get("vehicle")),
-        "vin": _safe(data.get("vin")),
-        "mileage": _safe(data.get("mileage")),
-        "concern": _safe(data.get("concern")),
-        "codes_symptoms": _safe(data.get("codes_symptoms") or data.get("diagnosis")),
-        "diag_steps": _safe(data.get("diag_steps") or data.get("diagnosis")),
-        "repair_steps": _safe(data.get("repair_steps") or data.get("repair")),
-        "extra_instructions": _safe(data.get("extra_instructions") or data.get("comment") or data.get("extra")),
-    }
+    return _build_prompt_cached(
+        _normalized_job_type(data),
+        _normalized_mode(data),
+        *(_field_value(data, keys) for _, keys in _PROMPT_FIELDS),
+    )
 
-    rules = "\n".join([t["base_rules"], t["mode_rules"][job_type], t["output_rules"]]).strip()
-    return (rules + "\n\n" + t["section_inputs"][mode].format(**ctx)).strip()
+
+@lru_cache(maxsize=128)
+def _build_prompt_cached(job_type: str, mode: str, *values: str) -> str:
+    # Replayed payloads (double-clicks, client retries) hit this cache within a warm container.
+    t = _TEMPLATES
+    ctx = dict(zip(_PROMPT_FIELD_NAMES, values))
+    ctx["job_type"] = job_type
+    ctx["mode"] = mode
+
+    rules = t["rules_by_job_type"][job_type]
+    section = "".join(literal + (ctx[field] if field else "") for literal, field in t["section_segments"][mode])
+    return (rules + "\n\n" + section).strip()
 
 
 def _extract_story(result: dict) -> str:
-    story = ""
-    for item in result.get("output", []):
-        for c in item.get("content", []):
-            if c.get("type") in ("output_text", "text"):
-                story += c.get("text", "")
-    return story.strip()
+    contents = chain.from_iterable(item.get("content", ()) for item in result.get("output", ()))
+    return "".join(c.get("text", "") for c in contents if c.get("type") in _STORY_CONTENT_TYPES).strip()
+
+
+def _openai_conn() -> http.client.HTTPSConnection:
+    # One keep-alive connection per container so warm invocations skip the TCP+TLS handshake.
+    global _OPENAI_CONN
+    if _OPENAI_CONN is None:
+        _OPENAI_CONN = http.client.HTTPSConnection(_OPENAI_URL_PARTS.netloc, timeout=_OPENAI_TIMEOUT)
+    return _OPENAI_CONN
+
+
+def _reset_openai_conn() -> None:
+    global _OPENAI_CONN, _OPENAI_CONN_WARM
+    _OPENAI_CONN_WARM = False
+    if _OPENAI_CONN is not None:
+        _OPENAI_CONN.close()
+        _OPENAI_CONN = None
+
+
+def _openai_post(body: bytes, headers: dict) -> bytes:
+    global _OPENAI_CONN_WARM
+    while True:
+        conn = _openai_conn()
+        warm = _OPENAI_CONN_WARM
+        try:
+            conn.request("POST", _OPENAI_URL_PARTS.path, body=body, headers=headers)
+            r = conn.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            _reset_openai_conn()
+            # A warm socket the server closed while idle never delivered the request, so it is
+            # resent once on a fresh connection. On a new connection OpenAI may already be
+            # generating, so the error is raised instead of paying for a second generation.
+            if warm:
+                continue
+            raise
+        except Exception:
+            _reset_openai_conn()
+            raise
+        try:
+            raw = r.read()
+        except Exception:
+            _reset_openai_conn()
+            raise
+        _OPENAI_CONN_WARM = True
+        if r.status >= 400:
+            raise urllib.error.HTTPError(OPENAI_URL, r.status, r.reason, r.headers, io.BytesIO(raw))
+        return raw
 
 
-def _openai_story_call(api_key: str, model: str, system_prompt: str, user_prompt: str) -> str:
+def _story_request_body(model: str, system_prompt: str, user_prompt: str) -> bytes:
     payload = {
         "model": model,
         "input": [
@@ -128,57 +288,60 @@ def _openai_story_call(api_key: str, model: str, system_prompt: str, user_prompt
             {"role": "user", "content": user_prompt},
         ],
     }
-    req = urllib.request.Request(
-        OPENAI_URL,
-        data=json.dumps(payload).encode("utf-8"),
-        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-        method="POST",
-    )
-    with urllib.request.urlopen(req, timeout=30) as r:
-        result = json.loads(r.read().decode("utf-8"))
+    # Compact separators keep the multi-KB prompt body small. ensure_ascii stays on so lone
+    # surrogates from truncated client input are escaped rather than failing to encode.
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def _openai_story_call(api_key: str, body: bytes) -> str:
+    # Headers are prebuilt alongside the cached key; only an uncached key builds them per call.
+    headers = _API_HEADERS if api_key == _API_KEY else _openai_headers(api_key)
+    raw = _openai_post(body, headers)
+    result = json.loads(raw)
     return _extract_story(result)
 
 
 def _validate_story_output(story: str) -> bool:
-    checks = [
-        r"(?m)^\s*[-*•]\s+",  # bullets
-        r"(?m)^\s*\d+[.)]\s+",  # numbered lists
-        r"\n\s*\n",  # empty lines
-        r"Customer states",  # forbidden phrase
-        r"(?mi)^\s*(VIN|Diagnosis|Repair|Parts|Time)\s*:",  # labels
-        r"[—–]",  # em/en dashes
-    ]
-    return not any(re.search(pattern, story) for pattern in checks)
+    if any(literal in story for literal in _FORMAT_VIOLATION_LITERALS):
+        return False
+    return _FORMAT_VIOLATION_RE.search(story) is None
 
 
 def _generate_with_validation(api_key: str, model: str, system_prompt: str, user_prompt: str) -> str:
-    prompt = user_prompt
+    body = _story_request_body(model, system_prompt, user_prompt)
+    retry_body = None
     for _ in range(MAX_GENERATION_ATTEMPTS):
-        story = _openai_story_call(api_key, model, system_prompt, prompt)
+        story = _openai_story_call(api_key, body)
         if _validate_story_output(story):
             return story
-        prompt = (
-            user_prompt
-            + "\n\nPrevious output violated formatting rules. Regenerate strictly."
-        )
+        # Every retry sends the same corrective prompt, so its body is encoded once.
+        if retry_body is None:
+            retry_body = _story_request_body(
+                model,
+                system_prompt,
+                user_prompt + "\n\nPrevious output violated formatting rules. Regenerate strictly.",
+            )
+        body = retry_body
     raise ValueError("Model output failed formatting validation after retries")
 
 
 def lambda_handler(event, context):
     method = event.get("requestContext", {}).get("http", {}).get("method", "")
     if method == "OPTIONS":
-        return _resp(200, {"ok": True})
+        return {**_OPTIONS_RESPONSE, "headers": dict(_RESPONSE_HEADERS)}
 
     try:
         body = event.get("body") or "{}"
         data = json.loads(body) if isinstance(body, str) else (body or {})
 
-        api_key = _get_openai_key()
+        # On a cache miss, fetch the key from SSM in the background while the prompt is assembled.
+        key_future = None if _openai_key_is_fresh() else _POOL.submit(_get_openai_key)
         model = _select_model(data)
 
-        t = _get_templates()
+        t = _TEMPLATES
         system_prompt = t["system_rules"]
         user_prompt = _build_prompt(data)
+        api_key = key_future.result() if key_future else _get_openai_key()
         story = _generate_with_validation(api_key, model, system_prompt, user_prompt)
 
         return _resp(200, {"story": story})
@@ -187,3 +350,32 @@ def lambda_handler(event, context):
         return _resp(502, {"error": f"OpenAI HTTPError {e.code}", "details": err[:2000]})
     except Exception as e:
         return _resp(500, {"error": str(e), "details": "Generation failed"})
+
+
+def _init() -> None:
+    # All cold-start work runs here at import, inside the Lambda init phase, so the first
+    # request finds templates loaded, the key cached, and the OpenAI socket already open.
+    global _TEMPLATES, _OPENAI_CONN_WARM
+    _TEMPLATES = _load_templates()
+    # Network warm-up runs only inside Lambda, so local imports and tests load the key lazily.
+    if not (os.environ.get("AWS_LAMBDA_FUNCTION_NAME") and os.environ.get("OPENAI_PARAM_NAME")):
+        return
+    # Network warm-up is best effort; the first request redoes whatever fails or is skipped here.
+    deadline = time.monotonic() + _INIT_WARMUP_BUDGET
+    try:
+        # The key fetch runs on the pool so init stops waiting at the deadline; an overrunning
+        # fetch finishes in the background and still fills the cache.
+        _POOL.submit(_get_openai_key).result(timeout=_INIT_WARMUP_BUDGET)
+        if deadline - time.monotonic() < _OPENAI_WARMUP_TIMEOUT:
+            return
+        conn = _openai_conn()
+        conn.timeout = _OPENAI_WARMUP_TIMEOUT
+        conn.connect()
+        conn.timeout = _OPENAI_TIMEOUT
+        conn.sock.settimeout(_OPENAI_TIMEOUT)
+        _OPENAI_CONN_WARM = True
+    except Exception:
+        _reset_openai_conn()
+
+
+_init()
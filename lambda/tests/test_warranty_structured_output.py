@@ -1,29 +1,59 @@
 import json
+import os
 import sys
+import tempfile
+import threading
 import types
 import unittest
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
+# boto3/botocore are provided by the Lambda runtime; stub them when running tests without them.
 mock_boto3 = types.SimpleNamespace(client=lambda *args, **kwargs: object())
 sys.modules.setdefault("boto3", mock_boto3)
+sys.modules.setdefault("botocore", types.ModuleType("botocore"))
+sys.modules.setdefault("botocore.config", types.SimpleNamespace(Config=lambda **kwargs: types.SimpleNamespace(**kwargs)))
 
-from lambda_function import _build_prompt, _validate_story_output, lambda_handler
+import lambda_function
+from lambda_function import _build_prompt, _extract_story, _validate_story_output, lambda_handler
+
+DIAG_REQUEST = {"job_type": "warranty", "mode": "diag", "concern": "No start"}
+VALID_STORY = "Verified concern and followed provided diagnostic steps with no additional assumptions"
+
+
+def _output(text):
+    return {"output": [{"content": [{"type": "output_text", "text": text}]}]}
 
 
 class _Resp:
-    def __init__(self, payload):
-        self.payload = payload
+    def __init__(self, payload, status=200, reason="OK"):
+        self.raw = json.dumps(payload).encode("utf-8")
+        self.status = status
+        self.reason = reason
+        self.headers = {}
 
     def read(self):
-        return json.dumps(self.payload).encode("utf-8")
+        return self.raw
+
+
+class _Conn:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.closed = False
 
-    def __enter__(self):
-        return self
+    def request(self, method, path, body=None, headers=None):
+        self.requests.append((method, path, body, headers))
 
-    def __exit__(self, exc_type, exc, tb):
-        return False
+    def getresponse(self):
+        resp = self.responses.pop(0)
+        if isinstance(resp, Exception):
+            raise resp
+        return resp
+
+    def close(self):
+        self.closed = True
 
 
 class TestPromptDrivenFlow(unittest.TestCase):
@@ -48,6 +78,32 @@ class TestPromptDrivenFlow(unittest.TestCase):
         self.assertIn("codes_symptoms=U0100", prompt)
         self.assertIn("repair_steps=Repaired damaged harness section", prompt)
 
+    def test_build_prompt_falls_back_to_frontend_fields(self):
+        prompt = _build_prompt(
+            {
+                "mode": "Warranty",
+                "sectionMode": "diag_repair",
+                "diagnosis": " Found open circuit ",
+                "repair": "Repaired wire",
+                "comment": "",
+                "extra": "Keep short",
+            }
+        )
+        self.assertIn("codes_symptoms=Found open circuit", prompt)
+        self.assertIn("diag_steps=Found open circuit", prompt)
+        self.assertIn("repair_steps=Repaired wire", prompt)
+        self.assertIn("extra_instructions=Keep short", prompt)
+
+    def test_build_prompt_reuses_cached_prompt_for_identical_inputs(self):
+        data = {"job_type": "cp", "mode": "repair_only", "vin": "1FTFW1E50NFA00002", "repair": "Replaced fuse"}
+        first = _build_prompt(data)
+        hits = lambda_function._build_prompt_cached.cache_info().hits
+        second = _build_prompt(dict(data, vin=" 1FTFW1E50NFA00002 "))
+
+        self.assertEqual(first, second)
+        self.assertEqual(lambda_function._build_prompt_cached.cache_info().hits, hits + 1)
+        self.assertIn("repair_steps=Replaced fuse", first)
+
     def test_output_validator_detects_forbidden_patterns(self):
         self.assertFalse(_validate_story_output("• Invalid bullet"))
         self.assertFalse(_validate_story_output("1. Numbered"))
@@ -57,34 +113,263 @@ class TestPromptDrivenFlow(unittest.TestCase):
         self.assertFalse(_validate_story_output("Bad dash — value"))
         self.assertTrue(_validate_story_output("Verified concern and performed directed diagnostics"))
 
-    def test_lambda_retries_on_failed_format_then_returns_valid_story(self):
+    def test_extract_story_joins_text_chunks_in_order(self):
+        result = {
+            "output": [
+                {"content": [{"type": "output_text", "text": "Verified concern "}, {"type": "refusal", "text": "x"}]},
+                {"type": "reasoning"},
+                {"content": [{"type": "text", "text": "and repaired harness "}]},
+            ]
+        }
+        self.assertEqual(_extract_story(result), "Verified concern and repaired harness")
+        self.assertEqual(_extract_story({}), "")
+
+
+class TestOpenAITransport(unittest.TestCase):
+    def _call(self, conns, calls=2):
+        body = lambda_function._story_request_body("gpt-4.1", "sys", "user")
+        with patch("lambda_function._OPENAI_CONN", None), patch("lambda_function._OPENAI_CONN_WARM", False), patch(
+            "lambda_function.http.client.HTTPSConnection", side_effect=conns
+        ) as mocked_conn:
+            results = []
+            for _ in range(calls):
+                try:
+                    results.append(lambda_function._openai_story_call("k", body))
+                except Exception as exc:
+                    results.append(exc)
+        return results, mocked_conn.call_count
+
+    def test_openai_connection_is_reused_and_reopened_when_stale(self):
+        ok = _output(VALID_STORY)
+        stale = _Conn([_Resp(ok), lambda_function.http.client.RemoteDisconnected("closed")])
+        fresh = _Conn([_Resp(ok)])
+
+        results, opened = self._call([stale, fresh])
+
+        self.assertEqual(results, [VALID_STORY, VALID_STORY])
+        self.assertTrue(stale.closed)
+        self.assertEqual(opened, 2)
+        self.assertEqual(len(stale.requests), 2)
+        self.assertEqual(len(fresh.requests), 1)
+
+    def test_openai_post_is_not_resent_on_a_new_connection(self):
+        new = _Conn([lambda_function.http.client.RemoteDisconnected("closed")])
+
+        results, opened = self._call([new], calls=1)
+
+        self.assertIsInstance(results[0], lambda_function.http.client.RemoteDisconnected)
+        self.assertEqual(opened, 1)
+        self.assertEqual(len(new.requests), 1)
+
+    def test_openai_post_is_not_resent_after_a_response_started(self):
+        ok = _output(VALID_STORY)
+        warm = _Conn([_Resp(ok), lambda_function.http.client.IncompleteRead(b"")])
+
+        results, opened = self._call([warm])
+
+        self.assertEqual(results[0], VALID_STORY)
+        self.assertIsInstance(results[1], lambda_function.http.client.IncompleteRead)
+        self.assertTrue(warm.closed)
+        self.assertEqual(opened, 1)
+        self.assertEqual(len(warm.requests), 2)
+
+
+class TestColdStartCaches(unittest.TestCase):
+    def test_init_warms_key_and_connection_when_configured(self):
+        conn = _Conn([])
+        conn.timeout = 30
+        conn.connect_timeouts = []
+        conn.sock = Mock()
+        conn.connect = lambda: conn.connect_timeouts.append(conn.timeout)
+
+        env = {"AWS_LAMBDA_FUNCTION_NAME": "tech-stories", "OPENAI_PARAM_NAME": "/TechStories/OPENAI_API_KEY"}
+        with patch.dict("os.environ", env), patch(
+            "lambda_function._get_openai_key", return_value="k"
+        ) as mocked_key, patch("lambda_function._openai_conn", return_value=conn), patch(
+            "lambda_function._OPENAI_CONN_WARM", False
+        ):
+            lambda_function._init()
+            self.assertTrue(lambda_function._OPENAI_CONN_WARM)
+
+        mocked_key.assert_called_once_with()
+        self.assertEqual(conn.connect_timeouts, [lambda_function._OPENAI_WARMUP_TIMEOUT])
+        self.assertEqual(conn.timeout, lambda_function._OPENAI_TIMEOUT)
+        conn.sock.settimeout.assert_called_once_with(lambda_function._OPENAI_TIMEOUT)
+        self.assertIn("diag", lambda_function._TEMPLATES["section_segments"])
+
+    def test_templates_load_from_prompt_bundle_when_present(self):
+        texts = lambda_function._load_prompt_texts(lambda_function._PROMPTS_DIR)
+        texts["system_rules"] = "Bundled system rules"
+        with tempfile.TemporaryDirectory() as pdir:
+            with open(os.path.join(pdir, "_bundle.json"), "w", encoding="utf-8") as f:
+                json.dump(texts, f)
+            templates = lambda_function._load_templates(pdir)
+
+        self.assertEqual(templates["system_rules"], "Bundled system rules")
+        self.assertIn("diag", templates["section_segments"])
+
+    def test_init_stops_network_warmup_at_its_deadline(self):
+        env = {"AWS_LAMBDA_FUNCTION_NAME": "tech-stories", "OPENAI_PARAM_NAME": "/TechStories/OPENAI_API_KEY"}
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slow_key = lambda: release.wait(5)
+        for key_fetch, budget in ((slow_key, 0.05), (lambda: "k", lambda_function._OPENAI_WARMUP_TIMEOUT - 1)):
+            with self.subTest(budget=budget), patch.dict("os.environ", env), patch(
+                "lambda_function._get_openai_key", side_effect=key_fetch
+            ), patch("lambda_function._INIT_WARMUP_BUDGET", budget), patch("lambda_function._openai_conn") as mocked_conn:
+                lambda_function._init()
+
+            mocked_conn.assert_not_called()
+
+    def test_init_skips_network_warmup_outside_lambda_or_without_param_name(self):
+        for env in ({"OPENAI_PARAM_NAME": "/TechStories/OPENAI_API_KEY"}, {"AWS_LAMBDA_FUNCTION_NAME": "tech-stories"}):
+            with self.subTest(env=env), patch.dict("os.environ", env, clear=True), patch(
+                "lambda_function._get_openai_key"
+            ) as mocked_key, patch("lambda_function._openai_conn") as mocked_conn:
+                lambda_function._init()
+
+            mocked_key.assert_not_called()
+            mocked_conn.assert_not_called()
+
+    def test_ssm_client_uses_short_timeouts_and_one_retry(self):
+        with patch("lambda_function._SSM", None), patch.object(sys.modules["boto3"], "client") as mocked_client:
+            client = lambda_function._ssm_client()
+            self.assertIs(lambda_function._ssm_client(), client)
+
+        mocked_client.assert_called_once()
+        self.assertEqual(mocked_client.call_args.args, ("ssm",))
+        config = mocked_client.call_args.kwargs["config"]
+        self.assertEqual(config.retries, {"total_max_attempts": 2, "mode": "standard"})
+        self.assertEqual((config.connect_timeout, config.read_timeout), (1, 3))
+        self.assertTrue(config.tcp_keepalive)
+        self.assertEqual(config.max_pool_connections, 1)
+
+    def test_openai_key_is_cached_across_invocations(self):
+        calls = []
+
+        class _Ssm:
+            def get_parameter(self, Name, WithDecryption):
+                calls.append(Name)
+                return {"Parameter": {"Value": "cached-key"}}
+
+        with patch.dict("os.environ", {"OPENAI_PARAM_NAME": "/TechStories/OPENAI_API_KEY"}), patch(
+            "lambda_function._ssm_client", return_value=_Ssm()
+        ), patch("lambda_function._API_KEY", None), patch("lambda_function._API_KEY_TS", 0.0), patch(
+            "lambda_function._API_HEADERS", None
+        ):
+            self.assertEqual(lambda_function._get_openai_key(), "cached-key")
+            self.assertEqual(lambda_function._get_openai_key(), "cached-key")
+            headers = lambda_function._API_HEADERS
+            self.assertEqual(headers["Authorization"], "Bearer cached-key")
+
+        self.assertEqual(calls, ["/TechStories/OPENAI_API_KEY"])
+
+
+class TestLambdaHandler(unittest.TestCase):
+    def setUp(self):
+        self.mocked_key = patch("lambda_function._get_openai_key", return_value="k").start()
+        self.addCleanup(patch.stopall)
+
+    def _invoke(self, responses, payload=None):
+        conn = _Conn(responses)
+        patch("lambda_function._openai_conn", return_value=conn).start()
         event = {
             "requestContext": {"http": {"method": "POST"}},
-            "body": json.dumps({"job_type": "warranty", "mode": "diag", "concern": "No start"}),
+            "body": json.dumps(payload or DIAG_REQUEST),
         }
+        return lambda_handler(event, None), conn
 
-        first = {"output": [{"content": [{"type": "output_text", "text": "• invalid"}]}]}
-        second = {
-            "output": [
-                {
-                    "content": [
-                        {
-                            "type": "output_text",
-                            "text": "Verified concern and followed provided diagnostic steps with no additional assumptions",
-                        }
-                    ]
-                }
-            ]
-        }
+    def test_lambda_retries_on_failed_format_then_returns_valid_story(self):
+        first = _output("• invalid")
+        second = _output(VALID_STORY)
 
-        with patch("lambda_function._get_openai_key", return_value="k"), patch(
-            "lambda_function.urllib.request.urlopen", side_effect=[_Resp(first), _Resp(second)]
-        ) as mocked_urlopen:
-            response = lambda_handler(event, None)
+        response, conn = self._invoke([_Resp(first), _Resp(second)])
 
         self.assertEqual(response["statusCode"], 200)
-        self.assertEqual(mocked_urlopen.call_count, 2)
-        self.assertIn("Verified concern", json.loads(response["body"])["story"])
+        self.assertEqual(len(conn.requests), 2)
+        self.assertEqual(conn.requests[0][:2], ("POST", "/v1/responses"))
+        self.assertEqual(json.loads(response["body"])["story"], VALID_STORY)
+        retry_input = json.loads(conn.requests[1][2])["input"][1]["content"]
+        self.assertTrue(retry_input.endswith("Previous output violated formatting rules. Regenerate strictly."))
+
+    def test_lambda_reuses_retry_body_and_fails_after_max_attempts(self):
+        invalid = _output("VIN: 123")
+
+        response, conn = self._invoke([_Resp(invalid), _Resp(invalid), _Resp(invalid)])
+
+        self.assertEqual(response["statusCode"], 500)
+        self.assertEqual(len(conn.requests), 3)
+        self.assertIs(conn.requests[1][2], conn.requests[2][2])
+
+    def test_lambda_returns_502_on_openai_http_error(self):
+        error = _Resp({"error": {"message": "rate limited"}}, status=429, reason="Too Many Requests")
+
+        response, _ = self._invoke([error])
+
+        self.assertEqual(response["statusCode"], 502)
+        body = json.loads(response["body"])
+        self.assertEqual(body["error"], "OpenAI HTTPError 429")
+        self.assertIn("rate limited", body["details"])
+
+    def test_lambda_forwards_lone_surrogate_input_escaped(self):
+        payload = json.loads('{"job_type": "warranty", "mode": "diag", "concern": "No start \\ud83d"}')
+
+        response, conn = self._invoke([_Resp(_output(VALID_STORY))], payload)
+
+        self.assertEqual(response["statusCode"], 200)
+        self.assertIn(b"No start \\ud83d", conn.requests[0][2])
+
+    def test_lambda_skips_background_key_fetch_when_key_is_fresh(self):
+        patch("lambda_function._openai_key_is_fresh", return_value=True).start()
+        pool = patch("lambda_function._POOL").start()
+
+        response, _ = self._invoke([_Resp(_output(VALID_STORY))])
+
+        self.assertEqual(response["statusCode"], 200)
+        pool.submit.assert_not_called()
+        self.mocked_key.assert_called_once_with()
+
+    def test_lambda_uses_background_key_fetch_on_cache_miss(self):
+        patch("lambda_function._openai_key_is_fresh", return_value=False).start()
+        pool = patch("lambda_function._POOL").start()
+        pool.submit.return_value.result.return_value = "pooled"
+
+        response, conn = self._invoke([_Resp(_output(VALID_STORY))])
+
+        self.assertEqual(response["statusCode"], 200)
+        pool.submit.assert_called_once_with(self.mocked_key)
+        self.assertEqual(conn.requests[0][3]["Authorization"], "Bearer pooled")
+
+    def test_lambda_returns_500_when_background_key_fetch_fails(self):
+        patch("lambda_function._openai_key_is_fresh", return_value=False).start()
+        self.mocked_key.side_effect = KeyError("OPENAI_PARAM_NAME")
+
+        response, conn = self._invoke([])
+
+        self.assertEqual(response["statusCode"], 500)
+        self.assertEqual(json.loads(response["body"])["details"], "Generation failed")
+        self.assertEqual(conn.requests, [])
+
+    def test_lambda_answers_options_preflight_without_calling_openai(self):
+        response = lambda_handler({"requestContext": {"http": {"method": "OPTIONS"}}}, None)
+
+        self.mocked_key.assert_not_called()
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(json.loads(response["body"]), {"ok": True})
+        self.assertEqual(response["headers"]["Access-Control-Allow-Methods"], "POST,OPTIONS")
+
+    def test_lambda_responses_do_not_share_mutable_headers(self):
+        preflight = {"requestContext": {"http": {"method": "OPTIONS"}}}
+        first = lambda_handler(preflight, None)
+        first["headers"]["X-Leak"] = "1"
+        first["statusCode"] = 418
+
+        second = lambda_handler(preflight, None)
+        error = lambda_function._resp(400, {"error": "bad"})
+
+        self.assertEqual(second["statusCode"], 200)
+        self.assertNotIn("X-Leak", second["headers"])
+        self.assertNotIn("X-Leak", error["headers"])
 
 
 if __name__ == "__main__":